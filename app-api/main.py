@@ -1,9 +1,14 @@
-import json
-from typing import AsyncGenerator, Dict, List
+import heapq
+import time
+from contextlib import asynccontextmanager
+from operator import itemgetter
+from typing import AsyncGenerator, AsyncIterator, Dict, List
 
 import httpx
+import orjson
+from cachetools import TTLCache
 from elasticsearch import AsyncElasticsearch
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -16,6 +21,13 @@ class Settings(BaseSettings):
     ollama_url: str = "http://localhost:11434/api/generate"
     index_name: str = "scrapbox-index"
     llm_model: str = "gemma3"
+    query_vector_cache_size: int = 1024
+    query_vector_cache_ttl: int = 3600
+    query_max_terms: int = 100
+    query_min_term_weight: float = 0.0
+    health_cache_ttl: float = 5.0
+    ollama_max_connections: int = 8
+    ollama_pool_timeout: float = 30.0
     
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
@@ -27,15 +39,53 @@ class QueryRequest(BaseModel):
     top_k: int = Field(default=5, description="Number of documents to retrieve")
 
 # --- App Initialization ---
-app = FastAPI(title="Cosense RAG App API")
 es_client = AsyncElasticsearch(settings.elasticsearch_url)
+# Sparse vectors of recent queries, keyed by normalized query text
+query_vector_cache: TTLCache = TTLCache(
+    maxsize=settings.query_vector_cache_size, ttl=settings.query_vector_cache_ttl
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Creates the shared HTTP clients on startup and releases connections on shutdown.
+    
+    SPLADE calls are short and share one pool. Ollama streams hold a connection for
+    the whole generation, so they get their own client: a burst of chats cannot
+    starve query vectorization, and waiting for a free stream slot times out.
+    """
+    app.state.splade_http = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+    )
+    app.state.ollama_http = httpx.AsyncClient(
+        # No read timeout for generation, but bounded waits for a connection
+        timeout=httpx.Timeout(None, connect=10.0, pool=settings.ollama_pool_timeout),
+        limits=httpx.Limits(
+            max_connections=settings.ollama_max_connections,
+            max_keepalive_connections=settings.ollama_max_connections,
+        ),
+    )
+    try:
+        yield
+    finally:
+        await app.state.splade_http.aclose()
+        await app.state.ollama_http.aclose()
+        await es_client.close()
+
+app = FastAPI(title="Cosense RAG App API", lifespan=lifespan)
+
+# Last Elasticsearch ping result, reused by /health for health_cache_ttl seconds
+last_ping = {"t": 0.0, "ok": False}
 
 # --- Service Logic ---
 
-async def get_query_vector(text: str) -> Dict[str, float]:
+async def get_query_vector(client: httpx.AsyncClient, text: str) -> Dict[str, float]:
     """Retrieves the sparse vector representation of the query from SPLADE API.
     
+    Results are cached per normalized query so repeated questions skip the SPLADE call.
+    
     Args:
+        client: Shared HTTP client used to reach the SPLADE API.
         text: User query string.
         
     Returns:
@@ -44,26 +94,33 @@ async def get_query_vector(text: str) -> Dict[str, float]:
     Raises:
         HTTPException: If the SPLADE API call fails.
     """
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            logger.info(f"Vectorizing query via {settings.splade_api_url}: {text[:50]}...")
-            response = await client.post(
-                settings.splade_api_url, 
-                json={"text": text}
-            )
-            response.raise_for_status()
-            data = response.json()
-            # Extract the sparse_vector from the response
-            return data.get("sparse_vector", {})
-        except httpx.HTTPStatusError as e:
-            logger.error(f"SPLADE API status error: {e.response.status_code} - {e.response.text}")
-            raise HTTPException(status_code=503, detail=f"Vectorization service error: {e.response.status_code}")
-        except httpx.RequestError as e:
-            logger.error(f"SPLADE API connection error: {e}")
-            raise HTTPException(status_code=503, detail="Vectorization service unreachable")
-        except Exception as e:
-            logger.exception(f"Unexpected error calling SPLADE API")
-            raise HTTPException(status_code=500, detail=str(e))
+    key = text.strip().lower()
+    cached = query_vector_cache.get(key)
+    if cached is not None:
+        logger.info(f"Query vector cache hit: {text[:50]}...")
+        return cached
+
+    try:
+        logger.info(f"Vectorizing query via {settings.splade_api_url}: {text[:50]}...")
+        response = await client.post(
+            settings.splade_api_url, 
+            json={"text": text}
+        )
+        response.raise_for_status()
+        data = response.json()
+        # Extract the sparse_vector from the response
+        query_vector = data.get("sparse_vector", {})
+        query_vector_cache[key] = query_vector
+        return query_vector
+    except httpx.HTTPStatusError as e:
+        logger.error(f"SPLADE API status error: {e.response.status_code} - {e.response.text}")
+        raise HTTPException(status_code=503, detail=f"Vectorization service error: {e.response.status_code}")
+    except httpx.RequestError as e:
+        logger.error(f"SPLADE API connection error: {e}")
+        raise HTTPException(status_code=503, detail="Vectorization service unreachable")
+    except Exception as e:
+        logger.exception(f"Unexpected error calling SPLADE API")
+        raise HTTPException(status_code=500, detail=str(e))
 
 async def search_documents(query_vector: Dict[str, float], top_k: int) -> List[Dict]:
     """Performs a sparse vector search on Elasticsearch using rank_features.
@@ -78,10 +135,19 @@ async def search_documents(query_vector: Dict[str, float], top_k: int) -> List[D
     if not query_vector:
         return []
 
-    # Build rank_feature query clauses for each token
+    # Keep only the heaviest tokens; every clause is a separate posting-list scan
+    terms = heapq.nlargest(
+        settings.query_max_terms,
+        (item for item in query_vector.items() if item[1] >= settings.query_min_term_weight),
+        key=itemgetter(1),
+    )
+    if not terms:
+        return []
+
+    # Build rank_feature query clauses for each remaining token
     should_clauses = [
         {"rank_feature": {"field": f"sparse_vector.{token}", "boost": weight}}
-        for token, weight in query_vector.items()
+        for token, weight in terms
     ]
 
     body = {
@@ -90,7 +156,9 @@ async def search_documents(query_vector: Dict[str, float], top_k: int) -> List[D
                 "should": should_clauses
             }
         },
-        "size": top_k
+        "size": top_k,
+        # Skip the stored sparse_vector; only these fields are used downstream
+        "_source": ["title", "content", "url"]
     }
 
     try:
@@ -112,6 +180,24 @@ async def search_documents(query_vector: Dict[str, float], top_k: int) -> List[D
         logger.error(f"Elasticsearch search error: {e}")
         return []
 
+async def aiter_ndjson(response: httpx.Response) -> AsyncIterator[bytes]:
+    """Splits a streamed NDJSON body into raw lines without decoding to str.
+    
+    Args:
+        response: Streaming HTTP response.
+        
+    Yields:
+        Each non-empty line as bytes.
+    """
+    pending = b""
+    async for data in response.aiter_bytes():
+        *lines, pending = (pending + data).split(b"\n")
+        for line in lines:
+            if line:
+                yield line
+    if pending:
+        yield pending
+
 def build_prompt(query: str, contexts: List[Dict]) -> str:
     """Constructs the augmented prompt for Gemma 3.
     
@@ -143,22 +229,31 @@ def build_prompt(query: str, contexts: List[Dict]) -> str:
 # 回答:
 """
 
-async def generate_response_stream(prompt: str, contexts: List[Dict]) -> AsyncGenerator[str, None]:
-    """Streams the response from Ollama/Gemma 3, prefixing with metadata.
+async def generate_response_stream(
+    client: httpx.AsyncClient, prompt: str, contexts: List[Dict]
+) -> AsyncGenerator[bytes, None]:
+    """Streams the response from Ollama/Gemma 3 as NDJSON events.
+    
+    The first line is a ``{"type": "metadata", ...}`` event carrying the sources
+    (title, url, score and content), followed by one ``{"type": "token", "text": ...}``
+    event per generated chunk.
+    Failures are reported as ``{"type": "error", "message": ...}``.
     
     Args:
+        client: HTTP client dedicated to Ollama streams.
         prompt: The constructed prompt.
         contexts: The supporting documents retrieved.
     """
-    # Send metadata first as a JSON object separated by a custom delimiter
+    # Send metadata first as its own NDJSON line; content is included so clients
+    # such as the evaluation script can score the retrieved contexts
     metadata = {
         "type": "metadata",
         "sources": [
-            {"title": c["title"], "url": c["url"], "score": c["score"]} 
+            {"title": c["title"], "url": c["url"], "score": c["score"], "content": c["content"]}
             for c in contexts
         ]
     }
-    yield json.dumps(metadata) + "\n---\n"
+    yield orjson.dumps(metadata) + b"\n"
 
     payload = {
         "model": settings.llm_model,
@@ -170,36 +265,33 @@ async def generate_response_stream(prompt: str, contexts: List[Dict]) -> AsyncGe
         }
     }
 
-    async with httpx.AsyncClient(timeout=None) as client:
-        try:
-            async with client.stream("POST", settings.ollama_url, json=payload) as response:
-                if response.status_code != 200:
-                    yield f"Error: LLM service returned {response.status_code}"
-                    return
-
-                async for line in response.aiter_lines():
-                    if not line:
-                        continue
-                    try:
-                        chunk = json.loads(line)
-                        if "response" in chunk:
-                            yield chunk["response"]
-                        if chunk.get("done"):
-                            break
-                    except json.JSONDecodeError:
-                        continue
-        except httpx.RequestError as e:
-            logger.error(f"Ollama connection error: {e}")
-            yield f"Error: Failed to connect to LLM service."
+    try:
+        async with client.stream("POST", settings.ollama_url, json=payload) as response:
+            if response.status_code != 200:
+                yield orjson.dumps({"type": "error", "message": f"LLM service returned {response.status_code}"}) + b"\n"
+                return
+
+            async for line in aiter_ndjson(response):
+                try:
+                    chunk = orjson.loads(line)
+                    if "response" in chunk:
+                        yield orjson.dumps({"type": "token", "text": chunk["response"]}) + b"\n"
+                    if chunk.get("done"):
+                        break
+                except orjson.JSONDecodeError:
+                    continue
+    except httpx.RequestError as e:
+        logger.error(f"Ollama connection error: {e}")
+        yield orjson.dumps({"type": "error", "message": "Failed to connect to LLM service."}) + b"\n"
 
 # --- API Endpoints ---
 
 @app.post("/query")
-async def query(request: QueryRequest):
+async def query(request: QueryRequest, http_request: Request):
     """Entry point for the RAG pipeline."""
     try:
         # 1. Vectorize query via SPLADE API
-        query_vector = await get_query_vector(request.user_query)
+        query_vector = await get_query_vector(http_request.app.state.splade_http, request.user_query)
         
         # 2. Retrieve relevant documents from Elasticsearch
         contexts = await search_documents(query_vector, request.top_k)
@@ -209,8 +301,8 @@ async def query(request: QueryRequest):
         
         # 4. Stream response from Gemma 3
         return StreamingResponse(
-            generate_response_stream(prompt, contexts),
-            media_type="text/event-stream"
+            generate_response_stream(http_request.app.state.ollama_http, prompt, contexts),
+            media_type="application/x-ndjson"
         )
     except HTTPException:
         raise
@@ -221,7 +313,11 @@ async def query(request: QueryRequest):
 @app.get("/health")
 async def health():
     """Health check endpoint."""
-    es_status = "connected" if await es_client.ping() else "disconnected"
+    now = time.monotonic()
+    if not last_ping["ok"] or now - last_ping["t"] >= settings.health_cache_ttl:
+        last_ping["ok"] = await es_client.ping()
+        last_ping["t"] = now
+    es_status = "connected" if last_ping["ok"] else "disconnected"
     return {"status": "up", "elasticsearch": es_status}
 
 if __name__ == "__main__":
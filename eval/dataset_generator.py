@@ -13,11 +13,17 @@ load_dotenv()
 ES_URL = os.getenv("ELASTICSEARCH_URL", "http://localhost:9200")
 INDEX_NAME = "scrapbox-index"
 
+# Shared client, closed by generate_testset once documents are fetched
+es = AsyncElasticsearch(ES_URL)
+
 async def fetch_documents_from_es(limit=50):
     """Fetch documents from Elasticsearch and convert to LangChain format."""
-    es = AsyncElasticsearch(ES_URL)
     try:
-        query = {"query": {"match_all": {}}, "size": limit}
+        query = {
+            "query": {"match_all": {}},
+            "size": limit,
+            "_source": ["title", "content", "url", "chunk_id"]
+        }
         response = await es.search(index=INDEX_NAME, body=query)
         hits = response["hits"]["hits"]
         
@@ -33,16 +39,17 @@ async def fetch_documents_from_es(limit=50):
             if content:
                 docs.append(Document(page_content=content, metadata=metadata))
         
-        await es.close()
         return docs
     except Exception as e:
         print(f"Error fetching from ES: {e}")
-        await es.close()
         return []
 
 async def generate_testset():
     print("Fetching documents from Elasticsearch...")
-    documents = await fetch_documents_from_es(limit=20)
+    try:
+        documents = await fetch_documents_from_es(limit=20)
+    finally:
+        await es.close()
     
     if not documents:
         print("No documents found in Elasticsearch. Please run the indexer first.")
@@ -1,8 +1,8 @@
 import os
-import json
 import asyncio
 import pandas as pd
 import httpx
+import orjson
 from datasets import Dataset
 from ragas import evaluate
 from ragas.metrics import faithfulness, answer_relevancy, context_precision, context_recall
@@ -12,6 +12,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 APP_API_URL = os.getenv("APP_API_URL", "http://localhost:8000/query")
+EVAL_CONCURRENCY = int(os.getenv("EVAL_CONCURRENCY", "4"))
 
 async def get_rag_response(question: str):
     """Calls app-api and extracts contexts and full answer."""
@@ -19,28 +20,22 @@ async def get_rag_response(question: str):
         try:
             payload = {"user_query": question, "top_k": 3}
             contexts = []
-            full_answer = ""
+            answer_parts: list[str] = []
             
             async with client.stream("POST", APP_API_URL, json=payload) as response:
                 if response.status_code != 200:
                     return None, None
                 
-                async for chunk in response.aiter_text():
-                    if "---" in chunk and not full_answer:
-                        # Split metadata and start of answer
-                        parts = chunk.split("---", 1)
-                        try:
-                            meta_data = json.loads(parts[0].strip())
-                            if meta_data.get("type") == "metadata":
-                                contexts = [s["content"] for s in meta_data.get("sources", [])]
-                            if len(parts) > 1:
-                                full_answer += parts[1].strip()
-                        except:
-                            pass
-                    else:
-                        full_answer += chunk
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    event = orjson.loads(line)
+                    if event.get("type") == "metadata":
+                        contexts = [s["content"] for s in event.get("sources", [])]
+                    elif event.get("type") == "token":
+                        answer_parts.append(event["text"])
             
-            return full_answer.strip(), contexts
+            return "".join(answer_parts).strip(), contexts
         except Exception as e:
             print(f"Error calling App API: {e}")
             return None, None
@@ -58,15 +53,18 @@ async def run_evaluation():
     questions = df_test["question"].tolist()
     ground_truths = df_test["ground_truth"].tolist()
     
-    answers = []
-    contexts_list = []
+    # Run several generations at once; the LLM stream is the bottleneck
+    sem = asyncio.Semaphore(EVAL_CONCURRENCY)
 
-    print("Running RAG pipeline for all questions...")
-    for q in questions:
-        print(f"Querying: {q}")
-        ans, ctx = await get_rag_response(q)
-        answers.append(ans if ans else "")
-        contexts_list.append(ctx if ctx else [])
+    async def run_one(q):
+        async with sem:
+            print(f"Querying: {q}")
+            return await get_rag_response(q)
+
+    print(f"Running RAG pipeline for all questions (concurrency={EVAL_CONCURRENCY})...")
+    results = await asyncio.gather(*(run_one(q) for q in questions))
+    answers = [ans if ans else "" for ans, _ in results]
+    contexts_list = [ctx if ctx else [] for _, ctx in results]
 
     # Prepare dataset for Ragas
     data = {
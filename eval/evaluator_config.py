@@ -1,5 +1,10 @@
 import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional, Tuple
 from langchain_ollama import ChatOllama
+from langchain_core.embeddings import Embeddings
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from dotenv import load_dotenv
 
@@ -7,7 +12,54 @@ load_dotenv()
 
 # Configuration for local Gemma 3 via Ollama
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-LLM_MODEL = os.getenv("LLM_MODEL", "gemma3") 
+LLM_MODEL = os.getenv("LLM_MODEL", "gemma3")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings instance with an in-memory LRU cache per text.
+
+    Ragas metrics embed many of the same strings (questions, answers, ground truths),
+    so sharing one cached instance avoids recomputing identical embeddings.
+    """
+
+    def __init__(self, underlying: Embeddings, maxsize: int = EMBEDDING_CACHE_SIZE):
+        self.underlying = underlying
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        # Ragas calls the async API, which runs these methods in worker threads
+        self._lock = threading.Lock()
+
+    def _get(self, key: Tuple[str, str]) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+            return vector
+
+    def _put(self, key: Tuple[str, str], vector: List[float]) -> None:
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embeds documents, encoding only texts that are not cached yet."""
+        cached = {text: self._get(("doc", text)) for text in texts}
+        missing = [text for text, vector in cached.items() if vector is None]
+        if missing:
+            for text, vector in zip(missing, self.underlying.embed_documents(missing)):
+                cached[text] = vector
+                self._put(("doc", text), vector)
+        return [cached[text] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embeds a query, reusing the cached vector when available."""
+        vector = self._get(("query", text))
+        if vector is None:
+            vector = self.underlying.embed_query(text)
+            self._put(("query", text), vector)
+        return vector
 
 def get_evaluator_llm():
     """Returns a raw LangChain LLM instance for Gemma 3."""
@@ -17,8 +69,11 @@ def get_evaluator_llm():
         temperature=0,
     )
 
+@lru_cache(maxsize=None)
 def get_evaluator_embeddings():
-    """Returns a raw LangChain Embeddings instance."""
-    return HuggingFaceEmbeddings(
-        model_name="BAAI/bge-small-en-v1.5"
+    """Returns a shared, cached LangChain Embeddings instance."""
+    return CachedEmbeddings(
+        HuggingFaceEmbeddings(
+            model_name="BAAI/bge-small-en-v1.5"
+        )
     )
@@ -1,11 +1,15 @@
 import json
 import os
 import argparse
+import hashlib
 import httpx
 import asyncio
+import orjson
 import urllib.parse
-from typing import List, Dict, Any
+from aiolimiter import AsyncLimiter
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
 from elasticsearch import AsyncElasticsearch, helpers
+from elasticsearch.serializer import JSONSerializer
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from dotenv import load_dotenv
 
@@ -14,16 +18,52 @@ load_dotenv()
 # Configuration
 ES_URL = os.getenv("ELASTICSEARCH_URL", "http://localhost:9200")
 SPLADE_API_URL = os.getenv("SPLADE_API_URL", "http://localhost:8001/encode")
+SPLADE_BATCH_API_URL = os.getenv(
+    "SPLADE_BATCH_API_URL", SPLADE_API_URL.rsplit("/", 1)[0] + "/encode_batch"
+)
 INDEX_NAME = "scrapbox-index"
+INDEX_NUMBER_OF_REPLICAS = int(os.getenv("INDEX_NUMBER_OF_REPLICAS", "1"))
+# Index settings used while bulk loading: no periodic refresh and no replicas
+BULK_LOAD_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
 SCRAPBOX_PROJECT = os.getenv("SCRAPBOX_PROJECT")
 SCRAPBOX_SID = os.getenv("SCRAPBOX_SID")
+SPLADE_CONCURRENCY = int(os.getenv("SPLADE_CONCURRENCY", "16"))
+SPLADE_BATCH_SIZE = int(os.getenv("SPLADE_BATCH_SIZE", "64"))
+# A failed SPLADE batch is retried up to this many times, split in half each time
+SPLADE_MAX_RETRIES = int(os.getenv("SPLADE_MAX_RETRIES", "3"))
+SPLADE_RETRY_BACKOFF = float(os.getenv("SPLADE_RETRY_BACKOFF", "1"))  # seconds, doubled per retry
+SCRAPBOX_CONCURRENCY = int(os.getenv("SCRAPBOX_CONCURRENCY", "8"))
+SCRAPBOX_RATE_LIMIT = float(os.getenv("SCRAPBOX_RATE_LIMIT", "10"))  # requests per second
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+# rank_features are stored as floats; smaller weights and extra digits only cost bytes.
+# The SPLADE batch API applies the same pruning and rounding server-side.
+MIN_TERM_WEIGHT = float(os.getenv("MIN_TERM_WEIGHT", "0.01"))
+# Maximum number of terms kept per chunk by the SPLADE API (0 keeps all of them)
+SPLADE_TOP_K = int(os.getenv("SPLADE_TOP_K", "256"))
+WEIGHT_PRECISION = 4
+
+class ORJSONSerializer(JSONSerializer):
+    """JSON serializer backed by orjson for faster bulk payload encoding."""
+
+    def json_dumps(self, data: Any) -> bytes:
+        return orjson.dumps(data, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def json_loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
 
 # Use AsyncElasticsearch
-es = AsyncElasticsearch(ES_URL)
+es = AsyncElasticsearch(ES_URL, serializer=ORJSONSerializer())
+# Shared SPLADE client so every chunk reuses keep-alive connections
+SPLADE_CLIENT = httpx.AsyncClient(
+    timeout=60.0,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+)
 
 async def create_index() -> None:
     """Create Elasticsearch index with rank_features mapping."""
     mapping = {
+        "settings": {**BULK_LOAD_SETTINGS, "number_of_shards": 1},
         "mappings": {
             "properties": {
                 "title": {"type": "text", "analyzer": "keyword"},
@@ -37,6 +77,7 @@ async def create_index() -> None:
     try:
         if await es.indices.exists(index=INDEX_NAME):
             print(f"Index {INDEX_NAME} already exists.")
+            await es.indices.put_settings(index=INDEX_NAME, settings=BULK_LOAD_SETTINGS)
             return
         await es.indices.create(index=INDEX_NAME, body=mapping)
         print(f"Created index {INDEX_NAME}")
@@ -44,17 +85,98 @@ async def create_index() -> None:
         print(f"Error creating index: {e}")
         raise
 
+async def finalize_index() -> None:
+    """Restore search-time index settings after a bulk load and merge segments."""
+    try:
+        await es.indices.put_settings(
+            index=INDEX_NAME,
+            settings={"refresh_interval": "1s", "number_of_replicas": INDEX_NUMBER_OF_REPLICAS},
+        )
+        # Merging a large index outlasts the client's request timeout, so it runs
+        # as a background task on the cluster
+        task = await es.indices.forcemerge(
+            index=INDEX_NAME, max_num_segments=1, wait_for_completion=False
+        )
+        print(f"Restored refresh settings for {INDEX_NAME}; merging segments (task {task.get('task')})")
+    except Exception as e:
+        print(f"Error finalizing index: {e}")
+        raise
+
 async def get_sparse_vector(text: str) -> Dict[str, float]:
     """Call SPLADE API to get sparse vector."""
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            response = await client.post(SPLADE_API_URL, json={"text": text})
-            response.raise_for_status()
-            data = response.json()
-            return data.get("sparse_vector", {})
-        except Exception as e:
-            print(f"Error calling SPLADE API: {e}")
-            return {}
+    try:
+        response = await SPLADE_CLIENT.post(SPLADE_API_URL, json={"text": text})
+        response.raise_for_status()
+        data = response.json()
+        return data.get("sparse_vector", {})
+    except Exception as e:
+        print(f"Error calling SPLADE API: {e}")
+        return {}
+
+def prune_vector(sparse_vector: Dict[str, float]) -> Dict[str, float]:
+    """Drop near-zero tail tokens and round weights for rank_features.
+
+    rank_features keys must be strings and values > 0.
+    """
+    return {
+        k: round(v, WEIGHT_PRECISION)
+        for k, v in sparse_vector.items() if v > MIN_TERM_WEIGHT
+    }
+
+async def get_sparse_vectors_batch(texts: List[str]) -> List[bytes]:
+    """Call SPLADE batch API to get sparse vectors for several texts in one request.
+
+    The batch API prunes weights at MIN_TERM_WEIGHT, keeps at most SPLADE_TOP_K
+    terms per text and streams one JSON object per line; each line is returned as
+    raw bytes so it can be spliced into the bulk body without building a Python
+    dict. Falls back to one request per text when the SPLADE API has no batch endpoint.
+
+    Raises:
+        httpx.HTTPError: If the request fails or times out.
+        ValueError: If the stream ends before every text has a vector.
+    """
+    response = await SPLADE_CLIENT.post(
+        SPLADE_BATCH_API_URL,
+        json={"texts": texts, "min_weight": MIN_TERM_WEIGHT, "top_k": SPLADE_TOP_K},
+    )
+    if response.status_code == 404:
+        return [orjson.dumps(prune_vector(await get_sparse_vector(text))) for text in texts]
+    response.raise_for_status()
+    # The body is buffered on purpose: a batch is used only once all of its lines
+    # have arrived, so a stream cut short is retried whole instead of leaving part
+    # of the batch indexed and the rest indexed again by the retry
+    vectors = response.content.splitlines()
+    if len(vectors) != len(texts):
+        raise ValueError(f"expected {len(texts)} vectors, got {len(vectors)}")
+    return vectors
+
+async def get_sparse_vectors_with_retry(
+    texts: List[str], retries: int = SPLADE_MAX_RETRIES
+) -> List[Optional[bytes]]:
+    """Get sparse vectors for a batch, retrying failed requests with smaller batches.
+
+    After a failure (timeouts of large batches on a busy SPLADE API, 5xx responses,
+    truncated streams) the batch is split in half and each half is retried after an
+    exponential backoff, until the retries run out.
+
+    Returns:
+        The vector of each text as in get_sparse_vectors_batch, or None for texts
+        that could not be encoded.
+    """
+    try:
+        return await get_sparse_vectors_batch(texts)
+    except Exception as e:
+        print(f"Error calling SPLADE batch API ({len(texts)} texts, {retries} retries left): {e}")
+    if retries == 0:
+        return [None] * len(texts)
+    await asyncio.sleep(SPLADE_RETRY_BACKOFF * 2 ** (SPLADE_MAX_RETRIES - retries))
+    if len(texts) == 1:
+        return await get_sparse_vectors_with_retry(texts, retries - 1)
+    mid = len(texts) // 2
+    return (
+        await get_sparse_vectors_with_retry(texts[:mid], retries - 1)
+        + await get_sparse_vectors_with_retry(texts[mid:], retries - 1)
+    )
 
 async def fetch_scrapbox_pages(project_name: str) -> List[Dict[str, str]]:
     """Fetch all pages from Scrapbox API."""
@@ -67,73 +189,156 @@ async def fetch_scrapbox_pages(project_name: str) -> List[Dict[str, str]]:
         try:
             response = await client.get(list_url)
             response.raise_for_status()
-            pages_data = response.json().get("pages", [])
+            pages_data = orjson.loads(response.content).get("pages", [])
         except Exception as e:
             print(f"Error fetching page list: {e}")
             return []
-        docs = []
-        for i, page in enumerate(pages_data):
+
+        sem = asyncio.Semaphore(SCRAPBOX_CONCURRENCY)
+        # Token bucket: bursts go out immediately, sustained rate stays under the limit
+        limiter = AsyncLimiter(SCRAPBOX_RATE_LIMIT, 1)
+
+        async def fetch_one(i: int, page: Dict[str, Any]) -> Optional[Dict[str, str]]:
             title = page.get("title")
-            print(f"[{i+1}/{len(pages_data)}] Fetching content for: {title}")
             safe_title = urllib.parse.quote(title)
             page_url = f"https://scrapbox.io/api/pages/{project_name}/{safe_title}"
-            try:
-                page_res = await client.get(page_url)
-                page_res.raise_for_status()
-                full_page = page_res.json()
-                lines = [line.get("text", "") for line in full_page.get("lines", [])]
-                content = "\n".join(lines)
-                public_url = f"https://scrapbox.io/{project_name}/{title.replace(' ', '_')}"
-                docs.append({"title": title, "content": content, "url": public_url})
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                print(f"Failed to fetch page '{title}': {e}")
+            async with sem:
+                print(f"[{i+1}/{len(pages_data)}] Fetching content for: {title}")
+                try:
+                    async with limiter:
+                        page_res = await client.get(page_url)
+                    page_res.raise_for_status()
+                    full_page = orjson.loads(page_res.content)
+                except Exception as e:
+                    print(f"Failed to fetch page '{title}': {e}")
+                    return None
+            lines = [line.get("text", "") for line in full_page.get("lines", [])]
+            content = "\n".join(lines)
+            public_url = f"https://scrapbox.io/{project_name}/{title.replace(' ', '_')}"
+            return {"title": title, "content": content, "url": public_url}
+
+        results = await asyncio.gather(
+            *(fetch_one(i, page) for i, page in enumerate(pages_data)),
+            return_exceptions=True,
+        )
+        docs = []
+        for page, result in zip(pages_data, results):
+            if isinstance(result, BaseException):
+                print(f"Failed to fetch page '{page.get('title')}': {result}")
+            elif result is not None:
+                docs.append(result)
         return docs
 
-async def index_documents(documents: List[Dict[str, str]]) -> None:
-    """Chunk, vectorize and index documents into Elasticsearch."""
+async def index_documents(documents: List[Dict[str, str]]) -> int:
+    """Chunk, vectorize and index documents into Elasticsearch.
+
+    Returns:
+        The number of chunks that could not be vectorized or indexed.
+    """
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50, separators=["\n\n", "\n", "。", "、", " ", ""])
-    actions = []
-    
-    async def run_batch(batch_actions):
+
+    # Split every document in one pass; doc_index lets chunks be traced back
+    chunks = text_splitter.create_documents(
+        [doc["content"] for doc in documents],
+        metadatas=[{"doc_index": idx} for idx in range(len(documents))],
+    )
+    chunk_meta = []
+    chunk_counts = [0] * len(documents)
+    for chunk in chunks:
+        doc_index = chunk.metadata["doc_index"]
+        chunk_meta.append((documents[doc_index], chunk_counts[doc_index], chunk.page_content))
+        chunk_counts[doc_index] += 1
+    print(f"Split {len(documents)} documents into {len(chunk_meta)} chunks.")
+
+    # Vectorize chunks in batches, running batches concurrently but bounded
+    # so the SPLADE API is not flooded
+    sem = asyncio.Semaphore(SPLADE_CONCURRENCY)
+
+    # Encode each distinct text once; duplicated chunks (templates, shared
+    # headers) reuse the vector of the first occurrence
+    texts = []
+    positions: List[List[int]] = []
+    seen: Dict[bytes, int] = {}
+    for pos, (doc, _, chunk_text) in enumerate(chunk_meta):
+        text = f"{doc['title']}\n{chunk_text}"
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        if key not in seen:
+            seen[key] = len(texts)
+            texts.append(text)
+            positions.append([])
+        positions[seen[key]].append(pos)
+
+    async def encode(start: int) -> Tuple[int, List[Optional[bytes]]]:
+        async with sem:
+            return start, await get_sparse_vectors_with_retry(texts[start:start + SPLADE_BATCH_SIZE])
+
+    # Chunks left out of the index because SPLADE failed for them or returned no terms
+    skipped = {"failed": 0, "empty": 0}
+
+    async def gen_actions() -> AsyncIterator[Dict[str, Any]]:
+        """Yield bulk actions as soon as each SPLADE batch finishes."""
+        tasks = [
+            asyncio.create_task(encode(start))
+            for start in range(0, len(texts), SPLADE_BATCH_SIZE)
+        ]
         try:
-            await helpers.async_bulk(es, batch_actions)
-            print(f"Indexed {len(batch_actions)} chunks...")
-        except helpers.BulkIndexError as e:
-            print(f"BulkIndexError: {len(e.errors)} documents failed.")
-            for error in e.errors:
-                print(f"Error detail: {json.dumps(error, indent=2)}")
-            raise
-
-    for doc in documents:
-        chunks = text_splitter.split_text(doc["content"])
-        print(f"Processing '{doc['title']}' ({len(chunks)} chunks)...")
-        for i, chunk_text in enumerate(chunks):
-            text_to_encode = f"{doc['title']}\n{chunk_text}"
-            sparse_vector = await get_sparse_vector(text_to_encode)
-            if not sparse_vector: continue
-            
-            # Filter for rank_features: keys must be strings, values > 0
-            filtered_vector = {k: v for k, v in sparse_vector.items() if v > 0}
-            if not filtered_vector: continue
-
-            action = {
-                "_index": INDEX_NAME,
-                "_source": {
-                    "title": doc["title"],
-                    "content": chunk_text,
-                    "url": doc["url"],
-                    "sparse_vector": filtered_vector,
-                    "chunk_id": i
-                }
-            }
-            actions.append(action)
-            if len(actions) >= 50:
-                await run_batch(actions)
-                actions = []
-    if actions:
-        await run_batch(actions)
-    print("Successfully finished indexing all documents.")
+            for next_batch in asyncio.as_completed(tasks):
+                start, vectors = await next_batch
+                for text_positions, raw_vector in zip(positions[start:start + SPLADE_BATCH_SIZE], vectors):
+                    if raw_vector is None:
+                        skipped["failed"] += len(text_positions)
+                        continue
+                    if raw_vector == b"{}":
+                        skipped["empty"] += len(text_positions)
+                        continue
+                    # Embed the SPLADE output verbatim; orjson writes fragments as-is
+                    sparse_vector = orjson.Fragment(raw_vector)
+
+                    for pos in text_positions:
+                        doc, i, chunk_text = chunk_meta[pos]
+                        yield {
+                            "_index": INDEX_NAME,
+                            "_source": {
+                                "title": doc["title"],
+                                "content": chunk_text,
+                                "url": doc["url"],
+                                "sparse_vector": sparse_vector,
+                                "chunk_id": i
+                            }
+                        }
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    print(f"Vectorizing {len(texts)} unique of {len(chunk_meta)} chunks (batch_size={SPLADE_BATCH_SIZE}, concurrency={SPLADE_CONCURRENCY})...")
+    indexed = 0
+    failed = 0
+    # Stream actions into Elasticsearch so bulk requests overlap with SPLADE encoding
+    async for ok, info in helpers.async_streaming_bulk(
+        es,
+        gen_actions(),
+        chunk_size=BULK_CHUNK_SIZE,
+        max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+        raise_on_error=False,
+    ):
+        if ok:
+            indexed += 1
+            if indexed % BULK_CHUNK_SIZE == 0:
+                print(f"Indexed {indexed} chunks...")
+        else:
+            failed += 1
+            print(f"Error detail: {json.dumps(info, indent=2)}")
+    if failed:
+        print(f"BulkIndexError: {failed} documents failed.")
+    if skipped["failed"]:
+        print(f"Skipped {skipped['failed']} chunks whose SPLADE vectors could not be computed.")
+    if skipped["empty"]:
+        print(f"Skipped {skipped['empty']} chunks with empty SPLADE vectors.")
+    if failed or skipped["failed"]:
+        print(f"Finished indexing with errors ({indexed} of {len(chunk_meta)} chunks indexed).")
+    else:
+        print(f"Successfully finished indexing all documents ({indexed} chunks).")
+    return failed + skipped["failed"]
 
 async def main():
     parser = argparse.ArgumentParser(description="Index Scrapbox via API.")
@@ -163,18 +368,27 @@ async def main():
     if not connected:
         print(f"Error: Could not connect to Elasticsearch at {ES_URL} after {max_retries} retries.")
         await es.close()
+        await SPLADE_CLIENT.aclose()
         return
 
     try:
         await create_index()
-        documents = await fetch_scrapbox_pages(project)
-        if documents:
-            await index_documents(documents)
-            print(f"Successfully finished indexing {len(documents)} pages.")
-        else:
-            print("No documents found to index.")
+        try:
+            # Fetched inside the guarded block: create_index has already
+            # disabled refresh, which finalize_index must restore
+            documents = await fetch_scrapbox_pages(project)
+            if documents:
+                if await index_documents(documents):
+                    print(f"Finished indexing {len(documents)} pages with errors.")
+                else:
+                    print(f"Successfully finished indexing {len(documents)} pages.")
+            else:
+                print("No documents found to index.")
+        finally:
+            await finalize_index()
     finally:
         await es.close()
+        await SPLADE_CLIENT.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())
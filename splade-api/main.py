@@ -1,91 +1,631 @@
+import os
+
+# Per-process CPU thread budget shared by torch, ONNX Runtime and the tokenizer
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "1"))
+
+# One intra-op thread per process avoids OpenMP/MKL oversubscription when several
+# uvicorn workers share the CPU; these must be set before torch is imported
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+# The Rust tokenizer parallelizes batch encoding on its own thread pool. uvicorn
+# starts workers with spawn rather than fork, so this is safe with several workers;
+# the pool is capped at the per-process budget so workers do not oversubscribe the CPU.
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+os.environ.setdefault("RAYON_NUM_THREADS", str(TORCH_NUM_THREADS))
+
+import asyncio
+import bisect
+import hashlib
+import numpy as np
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 import torch
-from fastapi import FastAPI, HTTPException
+from cachetools import LRUCache
+from contextlib import asynccontextmanager
+from functools import partial
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 from transformers import AutoModelForMaskedLM, AutoTokenizer
-from typing import Dict
+from typing import AsyncIterator, Dict, List, Tuple
 import uvicorn
-import os
 
-app = FastAPI(
-    title="SPLADE Vectorization API",
-    description="API to convert text into sparse vectors for Elasticsearch rank_features."
-)
+torch.set_num_threads(TORCH_NUM_THREADS)
+torch.set_num_interop_threads(1)
 
 # Model configuration
 MODEL_NAME = os.getenv("MODEL_NAME", "naver/splade-cocondenser-ensembledistil")
+# Dynamic batching: concurrent requests are coalesced into one forward pass
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "32"))
+MAX_BATCH_DELAY_MS = float(os.getenv("MAX_BATCH_DELAY_MS", "5"))
+# Coalesced requests are split by token length so short texts are not padded to long ones
+LENGTH_BUCKETS = [32, 64, 128, 256, 512]
+# With torch.compile, batches are also padded to one of these sizes (powers of two up to
+# MAX_BATCH_SIZE), so every forward pass hits a shape compiled during warmup
+BATCH_BUCKETS = sorted({min(2 ** i, MAX_BATCH_SIZE) for i in range(MAX_BATCH_SIZE.bit_length() + 1)})
+# Default cap on terms per vector; the heaviest terms carry nearly all of the score
+DEFAULT_TOP_K = int(os.getenv("DEFAULT_TOP_K", "256"))
+# Threads for host-side work (tokenizing, splitting rows, serializing responses)
+POSTPROCESS_NUM_THREADS = int(os.getenv("POSTPROCESS_NUM_THREADS", "2"))
+# Number of /encode results kept in memory; repeated texts skip the forward pass
+ENCODE_CACHE_SIZE = int(os.getenv("ENCODE_CACHE_SIZE", "10000"))
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# "auto" uses bfloat16 on GPU and float32 on CPU; otherwise a torch dtype name
+SPLADE_DTYPE = os.getenv("SPLADE_DTYPE", "auto")
+if SPLADE_DTYPE == "auto":
+    dtype = torch.bfloat16 if device.type == "cuda" else torch.float32
+else:
+    dtype = getattr(torch, SPLADE_DTYPE)
+# "onnx" serves the CPU path with ONNX Runtime via optimum (pip install "optimum[onnxruntime]").
+# SPLADE_ONNX_PATH may point to a pre-exported (optionally INT8-quantized) model directory;
+# otherwise MODEL_NAME is exported at startup. GPU always uses PyTorch.
+SPLADE_BACKEND = os.getenv("SPLADE_BACKEND", "torch")
+SPLADE_ONNX_PATH = os.getenv("SPLADE_ONNX_PATH")
+ORT_NUM_THREADS = int(os.getenv("ORT_NUM_THREADS", str(TORCH_NUM_THREADS)))
+use_onnx = SPLADE_BACKEND == "onnx" and device.type == "cpu"
+# torch.compile fuses kernels and captures CUDA Graphs; "auto" enables it on GPU only
+SPLADE_COMPILE = os.getenv("SPLADE_COMPILE", "auto")
+if SPLADE_COMPILE == "auto":
+    use_compile = device.type == "cuda"
+else:
+    use_compile = SPLADE_COMPILE.lower() in ("1", "true", "yes")
+use_compile = use_compile and not use_onnx
+# Fused scaled_dot_product_attention (FlashAttention / memory-efficient kernels) by default;
+# models without SDPA support fall back to the eager implementation
+SPLADE_ATTN = os.getenv("SPLADE_ATTN", "sdpa")
 
-print(f"Loading SPLADE model '{MODEL_NAME}' on {device}...")
+backend = "onnxruntime" if use_onnx else f"torch ({dtype})"
+print(f"Loading SPLADE model '{MODEL_NAME}' on {device} with {backend}...")
 try:
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-    model = AutoModelForMaskedLM.from_pretrained(MODEL_NAME).to(device)
-    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+    if not tokenizer.is_fast:
+        raise RuntimeError(f"No fast (Rust) tokenizer is available for '{MODEL_NAME}'")
+    if use_onnx:
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForMaskedLM
+
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = ORT_NUM_THREADS
+        model = ORTModelForMaskedLM.from_pretrained(
+            SPLADE_ONNX_PATH or MODEL_NAME,
+            export=SPLADE_ONNX_PATH is None,
+            provider="CPUExecutionProvider",
+            session_options=session_options,
+        )
+    else:
+        try:
+            model = AutoModelForMaskedLM.from_pretrained(
+                MODEL_NAME, torch_dtype=dtype, attn_implementation=SPLADE_ATTN
+            )
+        except (ValueError, ImportError) as e:
+            print(f"Attention implementation '{SPLADE_ATTN}' unavailable ({e}), using eager")
+            SPLADE_ATTN = "eager"
+            model = AutoModelForMaskedLM.from_pretrained(
+                MODEL_NAME, torch_dtype=dtype, attn_implementation=SPLADE_ATTN
+            )
+        model = model.to(device)
+        model.eval()
+        backend = f"torch ({dtype}, {SPLADE_ATTN} attention)"
 except Exception as e:
     print(f"Error loading model: {e}")
     raise e
 
+# Token ids are dense, so a list gives O(1) lookup without hashing.
+# Elasticsearch rank_features keys cannot contain dots '.', so they are
+# replaced with underscores '_' once here to avoid indexing errors.
+_vocab = tokenizer.get_vocab()
+ID_TO_TOKEN: List[str] = [""] * (max(_vocab.values()) + 1)
+for _token, _idx in _vocab.items():
+    ID_TO_TOKEN[_idx] = _token
+SAFE_TOKENS: List[str] = [token.replace(".", "_") for token in ID_TO_TOKEN]
+
+# Binary /encode responses: little-endian (uint32 token id, float16 weight) pairs,
+# 6 bytes per term; ids map to tokens through the /vocab list
+PACKED_MEDIA_TYPE = "application/octet-stream"
+PACKED_DTYPE = np.dtype([("id", "<u4"), ("weight", "<f2")])
+
+def splade_weights(logits: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """
+    SPLADE representation: max aggregation over tokens for each dimension.
+
+    log(1 + relu(w)) is the standard SPLADE weight calculation. Padding positions are
+    zeroed in place on the relu output (which is >= 0, so this cannot change the max),
+    and since log1p is monotonic it is applied after the max on the (batch, vocab)
+    result instead of on the full (batch, seq_len, vocab) tensor.
+
+    Args:
+        logits (torch.Tensor): MLM logits of shape (batch, seq_len, vocab).
+        attention_mask (torch.Tensor): Mask of shape (batch, seq_len).
+
+    Returns:
+        torch.Tensor: Weights of shape (batch, vocab).
+    """
+    activations = torch.relu(logits)
+    activations.masked_fill_(~attention_mask.bool().unsqueeze(-1), 0)
+    return torch.log1p(activations.amax(dim=1))
+
+if use_compile:
+    print("Compiling SPLADE model with torch.compile...")
+    # Allow one compiled graph per (batch, length) bucket pair;
+    # recompile_limit is named cache_size_limit before torch 2.7
+    _dynamo_config = torch._dynamo.config
+    _RECOMPILE_LIMIT_KEY = (
+        "recompile_limit" if hasattr(_dynamo_config, "recompile_limit") else "cache_size_limit"
+    )
+    _RECOMPILE_LIMIT = max(
+        getattr(_dynamo_config, _RECOMPILE_LIMIT_KEY), len(BATCH_BUCKETS) * len(LENGTH_BUCKETS)
+    )
+    setattr(_dynamo_config, _RECOMPILE_LIMIT_KEY, _RECOMPILE_LIMIT)
+    # Static shapes: one graph per (batch, length) bucket pair, all compiled by warmup()
+    model = torch.compile(model, mode="max-autotune", dynamic=False)
+    splade_weights = torch.compile(splade_weights, dynamic=False)
+
 class EncodeRequest(BaseModel):
     text: str
+    top_k: int = DEFAULT_TOP_K
+
+class EncodeBatchRequest(BaseModel):
+    texts: List[str]
+    min_weight: float = 0.0
+    top_k: int = DEFAULT_TOP_K
 
-class EncodeResponse(BaseModel):
-    sparse_vector: Dict[str, float]
+# (token ids, weights) of one sparse vector, heaviest first
+SparseEntries = Tuple[List[int], List[float]]
+# (text, min_weight, top_k, future resolved with the sparse entries)
+PendingItem = Tuple[str, float, int, asyncio.Future]
+# Unpadded tokenizer output of one text (input_ids, attention_mask, ...)
+Features = Dict[str, List[int]]
 
-@app.post("/encode", response_model=EncodeResponse)
-async def encode(request: EncodeRequest) -> EncodeResponse:
+# (text digest, top_k) -> sparse entries. Only touched from the event loop, so no lock is needed.
+encode_cache: LRUCache = LRUCache(maxsize=ENCODE_CACHE_SIZE)
+encode_cache_stats = {"hits": 0, "misses": 0}
+
+# Forward passes run on one dedicated thread so they never block the event loop
+# (which keeps accepting requests and answering /health) and never run concurrently.
+# Recent torch releases keep dynamo config overrides in context variables, which new
+# threads do not inherit, so the recompile limit set above is applied here as well.
+INFERENCE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="splade-inference",
+    initializer=(
+        partial(setattr, _dynamo_config, _RECOMPILE_LIMIT_KEY, _RECOMPILE_LIMIT)
+        if use_compile else None
+    ),
+)
+# Host-side work (tokenizing, splitting rows, building dicts, serializing) runs here,
+# so neither the inference thread nor the event loop spends time on it. Apart from
+# the Rust tokenizer it holds the GIL, so extra threads add little throughput; two
+# let the next batch be tokenized while the previous one is still being serialized.
+# Sized separately from TORCH_NUM_THREADS, which budgets the forward pass.
+POSTPROCESS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=POSTPROCESS_NUM_THREADS, thread_name_prefix="splade-postprocess"
+)
+
+def encode_texts(
+    features: List[Features], min_weights: List[float], top_ks: List[int]
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     """
-    Encode text into a sparse vector (token: weight) format for Elasticsearch.
+    Run a single padded SPLADE forward pass over a batch of tokenized texts.
 
     Args:
-        request (EncodeRequest): The request containing the text to encode.
+        features (List[Features]): The texts to encode, as returned by tokenize.
+        min_weights (List[float]): Per text, only tokens whose weight exceeds this value are kept.
+        top_ks (List[int]): Per text, at most this many of the heaviest tokens are kept
+            (0 or less keeps all of them).
 
     Returns:
-        EncodeResponse: A dictionary where keys are tokens and values are weights.
-            Dots in tokens are replaced with underscores for Elasticsearch compatibility.
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: Host tensors of the number of
+            kept entries per text, and the token ids and weights of all kept entries,
+            grouped by text in input order (see split_entries).
+    """
+    if use_compile:
+        # Pad up to the length bucket so the shapes captured by warmup() are reused
+        length = max(len(feature["input_ids"]) for feature in features)
+        bucket = LENGTH_BUCKETS[bisect.bisect_left(LENGTH_BUCKETS, length)]
+        inputs = tokenizer.pad(features, padding="max_length", max_length=bucket, return_tensors="pt")
+        # Fill the batch up to its bucket with copies of the first row; their
+        # outputs are dropped right after the forward pass
+        pad_rows = BATCH_BUCKETS[bisect.bisect_left(BATCH_BUCKETS, len(features))] - len(features)
+        if pad_rows:
+            inputs = {k: torch.cat([v, v[:1].expand(pad_rows, -1)]) for k, v in inputs.items()}
+    else:
+        # Pad to the longest text in the batch, not to max_length
+        inputs = tokenizer.pad(features, padding="longest", return_tensors="pt")
+    if device.type == "cuda":
+        # Page-locked host buffers let the copies run asynchronously with the forward launch
+        inputs = {k: v.pin_memory().to(device, non_blocking=True) for k, v in inputs.items()}
+
+    with torch.inference_mode():
+        logits = model(**inputs).logits
+        # Reduced-precision weights are cast back to float32 for extraction
+        weights = splade_weights(logits, inputs["attention_mask"])[:len(features)].float()
+
+    # Select the kept entries of the whole batch on the device, so only the
+    # (row, token id, weight) triples are copied to the host instead of the
+    # dense (batch, vocab) matrix. One topk at the largest requested k serves
+    # every row; each row is then cut to its own k and threshold.
+    vocab_size = weights.shape[-1]
+    row_ks = [k if 0 < k <= vocab_size else vocab_size for k in top_ks]
+    top_vals, top_ids = torch.topk(weights, k=max(row_ks), dim=-1)
+    thresholds = torch.tensor(min_weights, device=weights.device).clamp_(min=0).unsqueeze(-1)
+    ks = torch.tensor(row_ks, device=weights.device).unsqueeze(-1)
+    positions = torch.arange(top_vals.shape[-1], device=weights.device)
+    rows, ranks = ((top_vals > thresholds) & (positions < ks)).nonzero(as_tuple=True)
+    cols = top_ids[rows, ranks]
+    # Round to 4 decimals in one vectorized op, in float64. torch.round rounds the
+    # scaled binary value half-to-even, so ties can differ from round(weight, 4) in the
+    # last digit; the results are equivalent to within 1e-4
+    vals = top_vals[rows, ranks].double().mul_(10000).round_().div_(10000)
+    # nonzero is row-major, so each row's entries form one contiguous run
+    counts = torch.bincount(rows, minlength=len(features))
+    if device.type == "cuda":
+        counts, cols, vals = (t.to("cpu", non_blocking=True) for t in (counts, cols, vals))
+        torch.cuda.synchronize()
+    return counts, cols, vals
+
+def split_entries(
+    counts: torch.Tensor, ids: torch.Tensor, weights: torch.Tensor
+) -> List[SparseEntries]:
+    """
+    Split the batched output of encode_texts into per-text sparse entries.
+
+    Args:
+        counts (torch.Tensor): Number of kept entries per text.
+        ids (torch.Tensor): Token ids of all kept entries, grouped by text.
+        weights (torch.Tensor): Weights of all kept entries, grouped by text.
+
+    Returns:
+        List[SparseEntries]: The (token ids, weights) of each text, in order.
+    """
+    ids, weights_list = ids.tolist(), weights.tolist()
+    entries: List[SparseEntries] = []
+    start = 0
+    for count in counts.tolist():
+        end = start + count
+        entries.append((ids[start:end], weights_list[start:end]))
+        start = end
+    return entries
+
+def to_sparse_vector(entries: SparseEntries) -> Dict[str, float]:
+    """
+    Build the (token: weight) dict of a sparse vector.
+
+    Dots in tokens are replaced with underscores for Elasticsearch compatibility.
+
+    Args:
+        entries (SparseEntries): The token ids and weights.
+
+    Returns:
+        Dict[str, float]: The sparse vector keyed by token.
+    """
+    ids, weights = entries
+    return {SAFE_TOKENS[idx]: weight for idx, weight in zip(ids, weights)}
+
+def to_json(entries: SparseEntries) -> bytes:
+    """
+    Serialize the /encode response body, {"sparse_vector": {token: weight}}.
+
+    Args:
+        entries (SparseEntries): The token ids and weights.
+
+    Returns:
+        bytes: The JSON body.
+    """
+    return orjson.dumps({"sparse_vector": to_sparse_vector(entries)})
+
+def to_ndjson(page_entries: List[SparseEntries]) -> bytes:
+    """
+    Serialize sparse vectors as NDJSON, one (token: weight) object per line.
+
+    Args:
+        page_entries (List[SparseEntries]): The token ids and weights of each vector.
+
+    Returns:
+        bytes: The NDJSON lines, in order.
+    """
+    return b"".join(orjson.dumps(to_sparse_vector(entries)) + b"\n" for entries in page_entries)
+
+def pack_entries(entries: SparseEntries) -> bytes:
+    """
+    Pack a sparse vector as consecutive PACKED_DTYPE (uint32 id, float16 weight) pairs.
+
+    Args:
+        entries (SparseEntries): The token ids and weights.
+
+    Returns:
+        bytes: The packed pairs, 6 bytes each.
+    """
+    ids, weights = entries
+    packed = np.empty(len(ids), dtype=PACKED_DTYPE)
+    packed["id"] = ids
+    packed["weight"] = weights
+    return packed.tobytes()
+
+def tokenize(texts: List[str]) -> List[Features]:
+    """
+    Tokenize a batch of texts once, without padding or tensors.
+
+    The lengths are used for bucketing, and encode_texts pads each bucket.
+
+    Args:
+        texts (List[str]): The texts to tokenize.
+
+    Returns:
+        List[Features]: The truncated tokenizer output of each text, in order.
+    """
+    encoded = tokenizer(texts, truncation=True, max_length=512)
+    return [{key: values[i] for key, values in encoded.items()} for i in range(len(texts))]
+
+def settle(items: List[PendingItem], result: "asyncio.Future[List[SparseEntries]]") -> None:
+    """
+    Resolve the requests' futures with their entries, or with the raised error.
+
+    Args:
+        items (List[PendingItem]): The requests that were encoded together.
+        result (asyncio.Future[List[SparseEntries]]): The finished post-processing.
     """
+    if result.cancelled() or result.exception() is not None:
+        error = RuntimeError("post-processing cancelled") if result.cancelled() else result.exception()
+        print(f"Post-processing error: {error}")
+        for _, _, _, fut in items:
+            if not fut.done():
+                fut.set_exception(error)
+        return
+    for (_, _, _, fut), entries in zip(items, result.result()):
+        if not fut.done():
+            fut.set_result(entries)
+
+async def resolve_batch(items: List[PendingItem], features: List[Features]) -> None:
+    """
+    Run one forward pass for the given requests on the inference thread, then
+    hand the output to the post-processing pool, which resolves their futures.
+
+    Returns as soon as the forward pass is done, so the batcher can start the
+    next batch while this one is still being post-processed.
+
+    Args:
+        items (List[PendingItem]): The requests to encode together.
+        features (List[Features]): The tokenized text of each request.
+    """
+    loop = asyncio.get_running_loop()
     try:
-        inputs = tokenizer(request.text, return_tensors="pt", truncation=True, max_length=512).to(device)
-        
-        with torch.no_grad():
-            logits = model(**inputs).logits
-            
-        # SPLADE representation: max aggregation over tokens for each dimension
-        # log(1 + relu(w)) is the standard SPLADE weight calculation
-        weights = torch.max(
-            torch.log1p(torch.relu(logits)) * inputs.attention_mask.unsqueeze(-1), 
-            dim=1
-        ).values.squeeze()
-        
-        # Extract indices where weights are non-zero
-        indices = weights.nonzero().squeeze().cpu().tolist()
-        # Convert to list for mapping
-        weights_list = weights.cpu().tolist()
-        
-        # Map token IDs to actual tokens and their weights
-        id_to_token = {v: k for k, v in tokenizer.get_vocab().items()}
-        
-        sparse_vector = {}
-        # Ensure indices is iterable even if only one token is active
-        if isinstance(indices, int):
-            indices = [indices]
-            
-        for idx in indices:
-            token = id_to_token[idx]
-            weight = float(weights_list[idx])
-            if weight > 0:
-                # Elasticsearch rank_features keys cannot contain dots '.'
-                # Replace with underscores '_' to avoid indexing errors
-                safe_token = token.replace(".", "_")
-                sparse_vector[safe_token] = round(weight, 4)
-                
-        return EncodeResponse(sparse_vector=sparse_vector)
+        host_tensors = await loop.run_in_executor(
+            INFERENCE_EXECUTOR,
+            encode_texts,
+            features,
+            [min_weight for _, min_weight, _, _ in items],
+            [top_k for _, _, top_k, _ in items],
+        )
     except Exception as e:
         print(f"Inference error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        for _, _, _, fut in items:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    result = loop.run_in_executor(POSTPROCESS_EXECUTOR, split_entries, *host_tensors)
+    result.add_done_callback(lambda result: settle(items, result))
+
+async def batcher(queue: "asyncio.Queue[PendingItem]") -> None:
+    """
+    Coalesce queued requests into batches and resolve their futures.
+
+    Waits for a first request, then collects more for up to MAX_BATCH_DELAY_MS or
+    until MAX_BATCH_SIZE items are pending. The collected requests are grouped by
+    LENGTH_BUCKETS and each group runs as one forward pass on the inference thread,
+    shortest first. Requests arriving meanwhile queue up for the next batch.
+
+    Args:
+        queue (asyncio.Queue[PendingItem]): Queue fed by the encode endpoints.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        pending = [await queue.get()]
+        deadline = loop.time() + MAX_BATCH_DELAY_MS / 1000
+        while len(pending) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Skip requests whose clients have already gone away
+        pending = [item for item in pending if not item[3].done()]
+        if not pending:
+            continue
+        # Tokenize on the host pool, so the inference thread only runs forward passes
+        try:
+            features = await loop.run_in_executor(
+                POSTPROCESS_EXECUTOR, tokenize, [text for text, _, _, _ in pending]
+            )
+        except Exception as e:
+            print(f"Tokenization error: {e}")
+            for _, _, _, fut in pending:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+        buckets: Dict[int, List[Tuple[PendingItem, Features]]] = {}
+        for item, feature in zip(pending, features):
+            bucket = bisect.bisect_left(LENGTH_BUCKETS, len(feature["input_ids"]))
+            buckets.setdefault(bucket, []).append((item, feature))
+        for _, group in sorted(buckets.items()):
+            await resolve_batch([item for item, _ in group], [feature for _, feature in group])
+
+async def submit(
+    text: str, min_weight: float = 0.0, top_k: int = DEFAULT_TOP_K
+) -> SparseEntries:
+    """
+    Queue a text for the batcher and wait for its sparse entries.
+
+    Args:
+        text (str): The text to encode.
+        min_weight (float): Only tokens whose weight exceeds this value are kept.
+        top_k (int): At most this many of the heaviest tokens are kept (0 or less keeps all).
+
+    Returns:
+        SparseEntries: The token ids and weights for the text.
+    """
+    fut = asyncio.get_running_loop().create_future()
+    await app.state.queue.put((text, min_weight, top_k, fut))
+    return await fut
+
+def warmup() -> None:
+    """
+    Run forward passes at the served shapes before taking traffic.
+
+    With torch.compile this compiles and captures the CUDA Graphs for every
+    (BATCH_BUCKETS, LENGTH_BUCKETS) pair that encode_texts pads batches to;
+    otherwise a single-text pass per length initializes kernels and allocator caches.
+    """
+    batch_sizes, passes = (BATCH_BUCKETS, 3) if use_compile else ([1], 1)
+    for batch_size in batch_sizes:
+        for length in LENGTH_BUCKETS:
+            dummy = tokenizer(
+                [""] * batch_size, return_tensors="pt", padding="max_length", max_length=length
+            )
+            dummy = {k: v.to(device) for k, v in dummy.items()}
+            with torch.inference_mode():
+                for _ in range(passes):
+                    splade_weights(model(**dummy).logits, dummy["attention_mask"])
+    print("Warmup finished")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Warm up and start the batching worker on startup, and stop it on shutdown."""
+    # Queued on the inference thread first, so requests arriving meanwhile wait behind it
+    app.state.warmup = asyncio.get_running_loop().run_in_executor(INFERENCE_EXECUTOR, warmup)
+    app.state.queue = asyncio.Queue()
+    worker = asyncio.create_task(batcher(app.state.queue))
+    try:
+        yield
+    finally:
+        worker.cancel()
+        INFERENCE_EXECUTOR.shutdown(wait=False)
+        POSTPROCESS_EXECUTOR.shutdown(wait=False)
+
+app = FastAPI(
+    title="SPLADE Vectorization API",
+    description="API to convert text into sparse vectors for Elasticsearch rank_features.",
+    lifespan=lifespan
+)
+
+@app.post("/encode")
+async def encode(request: EncodeRequest, http_request: Request) -> Response:
+    """
+    Encode text into a sparse vector (token: weight) format for Elasticsearch.
+
+    Results are cached per (text, top_k); concurrent cache misses are batched
+    together into a single forward pass.
+
+    Args:
+        request (EncodeRequest): The text to encode and the maximum number of terms to keep.
+        http_request (Request): The raw request, used for content negotiation.
+
+    Returns:
+        Response: JSON {"sparse_vector": {token: weight}}, serialized with orjson.
+            Dots in tokens are replaced with underscores for Elasticsearch compatibility.
+            With "Accept: application/octet-stream", the entries are returned packed as
+            PACKED_DTYPE pairs instead (token ids index the /vocab list).
+    """
+    key = (hashlib.blake2b(request.text.encode(), digest_size=16).digest(), request.top_k)
+    entries = encode_cache.get(key)
+    if entries is not None:
+        encode_cache_stats["hits"] += 1
+    else:
+        encode_cache_stats["misses"] += 1
+        try:
+            entries = await submit(request.text, top_k=request.top_k)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        encode_cache[key] = entries
+    # The body is built on the host pool, off the event loop; the dict is already
+    # well-formed, so response-model validation is skipped
+    if PACKED_MEDIA_TYPE in http_request.headers.get("accept", ""):
+        serialize, media_type = pack_entries, PACKED_MEDIA_TYPE
+    else:
+        serialize, media_type = to_json, "application/json"
+    content = await asyncio.get_running_loop().run_in_executor(
+        POSTPROCESS_EXECUTOR, serialize, entries
+    )
+    return Response(content=content, media_type=media_type)
+
+@app.post("/encode_batch")
+async def encode_batch(request: EncodeBatchRequest) -> StreamingResponse:
+    """
+    Encode a list of texts into sparse vectors through the dynamic batcher.
+
+    Texts are submitted in pages of MAX_BATCH_SIZE, with the next page queued while
+    the current one is encoded, and each page is streamed out as soon as it is done.
+
+    Args:
+        request (EncodeBatchRequest): The texts to encode, the minimum weight and the
+            maximum number of terms to keep.
+
+    Returns:
+        StreamingResponse: NDJSON body with one sparse vector object per line, in the
+            same order as the input texts. Each line is a bare (token: weight) object so
+            clients can embed it in Elasticsearch bulk bodies without re-parsing.
+            An inference error aborts the stream, leaving fewer lines than texts.
+    """
+    pages = [
+        request.texts[i:i + MAX_BATCH_SIZE] for i in range(0, len(request.texts), MAX_BATCH_SIZE)
+    ]
+
+    def schedule(page: List[str]) -> "asyncio.Future[List[SparseEntries]]":
+        return asyncio.gather(*(submit(text, request.min_weight, request.top_k) for text in page))
+
+    async def stream() -> AsyncIterator[bytes]:
+        upcoming = schedule(pages[0]) if pages else None
+        try:
+            for i in range(len(pages)):
+                current = upcoming
+                upcoming = schedule(pages[i + 1]) if i + 1 < len(pages) else None
+                page_entries = await current
+                yield await asyncio.get_running_loop().run_in_executor(
+                    POSTPROCESS_EXECUTOR, to_ndjson, page_entries
+                )
+        finally:
+            # Client gone or inference failed: drop the page still waiting in the queue
+            if upcoming is not None:
+                upcoming.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/vocab")
+async def vocab() -> List[str]:
+    """
+    Token list for decoding binary /encode responses: a packed id indexes this list.
+
+    Dots in tokens are replaced with underscores, as in the JSON responses.
+    """
+    return SAFE_TOKENS
+
+@app.get("/cache_info")
+async def cache_info():
+    """Report /encode cache usage so ENCODE_CACHE_SIZE can be tuned."""
+    return {**encode_cache_stats, "size": encode_cache.currsize, "maxsize": encode_cache.maxsize}
+
+@app.get("/warmup")
+async def warmup_status():
+    """
+    Readiness endpoint: 503 until warmup has finished, so orchestration can hold
+    traffic back while the model is compiled and its graphs are captured.
+
+    Warmup runs in every worker process, so this only reports the worker that
+    answered; serve.py runs a single worker unless WEB_CONCURRENCY is raised.
+    """
+    if not app.state.warmup.done():
+        raise HTTPException(status_code=503, detail="warming up")
+    if app.state.warmup.exception() is not None:
+        raise HTTPException(status_code=500, detail=str(app.state.warmup.exception()))
+    return {"status": "ready"}
 
 @app.get("/health")
 async def health():
     """Health check endpoint."""
-    return {"status": "ok", "device": str(device), "model": MODEL_NAME}
+    return {"status": "ok", "device": str(device), "backend": backend, "model": MODEL_NAME}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    # Single process for local runs; serve.py starts multiple workers
+    uvicorn.run(app, host="0.0.0.0", port=8001, loop="uvloop", http="httptools")
@@ -0,0 +1,20 @@
+import os
+
+import uvicorn
+
+# Launcher for multiple uvicorn workers. Workers are spawned and import main:app
+# themselves, so the model is loaded once per worker and never in this process
+# (running main.py with workers would import it twice in every worker).
+
+if __name__ == "__main__":
+    # Each worker holds its own model copy (and compiled graphs) and its own dynamic
+    # batcher, so a single worker is the default; scale out with WEB_CONCURRENCY
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8001,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+    )
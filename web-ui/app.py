@@ -2,6 +2,7 @@ import streamlit as st
 import httpx
 import os
 import json
+import time
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -9,6 +10,8 @@ load_dotenv()
 
 # Configuration
 APP_API_URL = os.getenv("APP_API_URL", "http://localhost:8000")
+# Minimum seconds between re-renders of the streaming answer (~20 Hz)
+RENDER_INTERVAL = float(os.getenv("RENDER_INTERVAL", "0.05"))
 
 st.set_page_config(
     page_title="Cosense RAG Chat",
@@ -16,6 +19,15 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_resource
+def get_client() -> httpx.Client:
+    """Return a shared HTTP client so follow-up questions reuse pooled connections."""
+    return httpx.Client(
+        http2=True,
+        timeout=None,
+        limits=httpx.Limits(max_keepalive_connections=8, max_connections=32)
+    )
+
 def init_session_state():
     """Initialize Streamlit session state."""
     if "messages" not in st.session_state:
@@ -65,44 +77,41 @@ def main():
         with st.chat_message("assistant"):
             response_placeholder = st.empty()
             full_response = ""
+            response_parts = []
             sources = []
+            last_render = 0.0
             
             try:
                 # Call App API with streaming
                 api_endpoint = f"{APP_API_URL.rstrip('/')}/query"
-                with httpx.stream(
+                with get_client().stream(
                     "POST", 
                     api_endpoint, 
-                    json={"user_query": prompt, "top_k": top_k}, 
-                    timeout=None
+                    json={"user_query": prompt, "top_k": top_k}
                 ) as response:
                     if response.status_code != 200:
                         st.error(f"API Error: {response.status_code} (Endpoint: {api_endpoint})")
                     else:
-                        buffer = ""
-                        metadata_received = False
-                        
-                        for chunk in response.iter_text():
-                            buffer += chunk
-                            
-                            # Try to extract metadata if not yet received
-                            if not metadata_received and "\n---\n" in buffer:
-                                parts = buffer.split("\n---\n", 1)
-                                try:
-                                    metadata_str = parts[0]
-                                    metadata = json.loads(metadata_str)
-                                    if metadata.get("type") == "metadata":
-                                        sources = metadata.get("sources", [])
-                                        metadata_received = True
-                                        buffer = parts[1] # Keep the rest of the text
-                                except json.JSONDecodeError:
-                                    pass
-                            
-                            if metadata_received:
-                                full_response = buffer
-                                response_placeholder.markdown(full_response + "▌")
+                        # The App API streams NDJSON: a metadata event, then token events
+                        for line in response.iter_lines():
+                            if not line:
+                                continue
+                            event = json.loads(line)
+                            if event.get("type") == "metadata":
+                                sources = event.get("sources", [])
+                            elif event.get("type") == "token":
+                                response_parts.append(event["text"])
+                                # Re-rendering the whole Markdown per token is quadratic
+                                # in the answer length, so repaint at a bounded rate
+                                now = time.monotonic()
+                                if now - last_render >= RENDER_INTERVAL:
+                                    response_placeholder.markdown("".join(response_parts) + "▌")
+                                    last_render = now
+                            elif event.get("type") == "error":
+                                st.error(event.get("message", "Unknown error"))
                         
                         # Final update
+                        full_response = "".join(response_parts)
                         response_placeholder.markdown(full_response)
                         
                         # Display sources in an expander